@@ -0,0 +1,55 @@
+from log_config import logger
+import datetime
+import boto3
+
+# Assumed role clients, reused across warm invocations while credentials are valid
+assumed_role_clients = None
+assumed_role_expiration = None
+
+
+def assume_role(sts_client, role_arn):
+    """
+    Assumes the specified role and returns temporary credentials.
+    """
+    try:
+        response = sts_client.assume_role(
+            RoleArn=role_arn, RoleSessionName="FinOpsBudgetSetterSession"
+        )
+        logger.info("Assumed role %s successfully.", role_arn)
+        return response["Credentials"]
+    except Exception as e:
+        logger.error("Failed to assume role %s: %s", role_arn, e)
+        raise
+
+
+def initialize_boto3_clients(credentials, client_config):
+    """
+    Initialize Boto3 clients using assumed role credentials.
+    """
+    assumed_session = boto3.Session(
+        aws_access_key_id=credentials["AccessKeyId"],
+        aws_secret_access_key=credentials["SecretAccessKey"],
+        aws_session_token=credentials["SessionToken"],
+    )
+
+    ce_client = assumed_session.client("ce", config=client_config)
+    budgets_client = assumed_session.client("budgets", config=client_config)
+    sts_core_mgmt_client = assumed_session.client("sts", config=client_config)
+    return ce_client, budgets_client, sts_core_mgmt_client
+
+
+def get_assumed_role_clients(sts_client, role_arn, client_config):
+    """
+    Returns Boto3 clients for the assumed role. Clients from a previous warm invocation
+    are reused as long as their credentials outlive the maximum Lambda run time.
+    """
+    global assumed_role_clients, assumed_role_expiration
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if (
+        assumed_role_clients is None
+        or assumed_role_expiration - now < datetime.timedelta(minutes=15)
+    ):
+        credentials = assume_role(sts_client, role_arn)
+        assumed_role_clients = initialize_boto3_clients(credentials, client_config)
+        assumed_role_expiration = credentials["Expiration"]
+    return assumed_role_clients
@@ -1,17 +1,33 @@
 import boto3
 import datetime
 import json
+import logging
 from collections import defaultdict
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+from botocore.config import Config
 from log_config import logger
-from metadata_loader import load_metadata_from_s3, retrieve_metadata_per_workload
+from metadata_loader import (
+    load_cached_metadata_from_s3,
+    retrieve_metadata_per_workload,
+)
+
 
+# Shared client config so concurrent workload processing doesn't exhaust the
+# connection pool or fail on Cost Explorer throttling
+client_config = Config(
+    max_pool_connections=32,
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    connect_timeout=3,
+    read_timeout=30,
+)
 
 # Set Boto3 clients
-sts_client = boto3.client("sts")
-ce_client = boto3.client("ce")
-budgets_client = boto3.client("budgets")
-s3_client = boto3.client("s3")
+sts_client = boto3.client("sts", config=client_config)
+ce_client = boto3.client("ce", config=client_config)
+budgets_client = boto3.client("budgets", config=client_config)
+s3_client = boto3.client("s3", config=client_config)
 
 # FinOps email
 finops_email = os.getenv("FINOPS_EMAIL", "")
@@ -22,89 +38,71 @@ account_metadata_filename = os.getenv(
 account_metadata_bucket = os.getenv(
     "ACCOUNT_METADATA_BUCKET", "artifacts-finops-dvb-sbx"
 )
+max_workers = int(os.getenv("MAX_WORKERS", "16"))
+# Minimum budget in USD to avoid email spam
+min_budget = 500.0
 
-
-def assume_role(role_arn):
-    """
-    Assumes the specified role and returns temporary credentials.
-    """
-    try:
-        response = sts_client.assume_role(
-            RoleArn=role_arn, RoleSessionName="FinOpsBudgetSetterSession"
-        )
-        logger.info(f"Assumed role {role_arn} successfully.")
-        return response["Credentials"]
-    except Exception as e:
-        logger.error(f"Failed to assume role {role_arn}: {e}")
-        raise
+# Account where the budgets are managed, looked up once per execution environment
+root_account_id = None
 
 
-def initialize_boto3_clients(credentials):
+def get_clients():
     """
-    Initialize Boto3 clients using assumed role credentials.
+    Returns the CE, Budgets and STS clients to use, assuming ASSUME_ROLE_ARN when set.
     """
-    assumed_session = boto3.Session(
-        aws_access_key_id=credentials["AccessKeyId"],
-        aws_secret_access_key=credentials["SecretAccessKey"],
-        aws_session_token=credentials["SessionToken"],
-    )
+    if not role_arn:
+        return ce_client, budgets_client, sts_client
 
-    ce_client = assumed_session.client("ce")
-    budgets_client = assumed_session.client("budgets")
-    sts_core_mgmt_client = assumed_session.client("sts")
-    return ce_client, budgets_client, sts_core_mgmt_client
+    # Only load the assume role code path when a role is configured
+    from assumed_role import get_assumed_role_clients
 
+    return get_assumed_role_clients(sts_client, role_arn, client_config)
 
-def get_all_accounts(ce_client, start_date: str, end_date: str):
+
+def iter_accounts(ce_client, start_date: str, end_date: str):
     """
-    Retrieves all accounts under the centralised organisation.
+    Yields (name, id) for all accounts under the centralised organisation, page by page.
     """
-    response = ce_client.get_dimension_values(
-        Dimension="LINKED_ACCOUNT",
-        TimePeriod={"Start": start_date, "End": end_date},
-        MaxResults=2000,
-    )
-    accounts = [
-        {
-            "name": account.get("Attributes", {}).get("description", ""),
-            "id": account["Value"],
-        }
-        for account in response["DimensionValues"]
-    ]
-    logger.debug("Accounts have been retrieved and stored in a dictionary")
-    logger.debug(json.dumps(accounts, sort_keys=True))
-    return accounts
+    request = {
+        "Dimension": "LINKED_ACCOUNT",
+        "TimePeriod": {"Start": start_date, "End": end_date},
+        "MaxResults": 2000,
+    }
+    # Cost Explorer has no paginator for get_dimension_values, so follow the token
+    while True:
+        response = ce_client.get_dimension_values(**request)
+        for account in response["DimensionValues"]:
+            yield account.get("Attributes", {}).get("description", ""), account["Value"]
+        token = response.get("NextPageToken")
+        if not token:
+            break
+        request["NextPageToken"] = token
+    logger.debug("Accounts have been retrieved")
 
 
 def group_accounts_by_workload(accounts):
     """
-    Groups accounts by workload based on the naming convention: {workloadname}-{env}.
-    If an account name does not follow the naming convention then it is skipped.
-    This function uses rsplit so that workloads containing hyphens are still supported.
+    Groups (name, id) accounts by workload based on the naming convention:
+    {workloadname}-{env}. If an account name does not follow the naming convention
+    then it is skipped.
+    This function uses rpartition so that workloads containing hyphens are still supported.
     """
     workload_accounts = defaultdict(list)
-    for account in accounts:
-        account_name = account["name"]
-        account_id = account["id"]
-        # Expect account name to have at least one hyphen
-        if "-" in account_name:
-            # Split on the last hyphen to separate workload and env, e.g. "ecommerce-prod"
-            parts = account_name.rsplit("-", 1)
-            if len(parts) == 2:
-                workload = parts[0]
-                workload_accounts[workload].append(account_id)
-            else:
-                logger.warning(
-                    f"Account {account_name} does not follow the expected naming convention."
-                )
+    for account_name, account_id in accounts:
+        # Split on the last hyphen to separate workload and env, e.g. "ecommerce-prod"
+        workload, separator, _ = account_name.rpartition("-")
+        if separator:
+            workload_accounts[workload].append(account_id)
         else:
             logger.warning(
-                f"Account {account_name} does not follow the expected naming convention."
+                "Account %s does not follow the expected naming convention.",
+                account_name,
             )
-        logger.debug(
-            "Accounts have been grouped based on workload (text before '-' in accountname)"
-        )
-        logger.debug(json.dumps(workload_accounts, sort_keys=True))
+    logger.debug(
+        "Accounts have been grouped based on workload (text before '-' in accountname)"
+    )
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(json.dumps(workload_accounts))
     return workload_accounts
 
 
@@ -114,46 +112,57 @@ def get_previous_month_date_range():
     For example, if today is 15 November then this returns 1 October to 31 October.
     """
     today = datetime.date.today()
-    # Get first day of current month
-    first_day_current_month = today.replace(day=1)
+    # Previous month, wrapping January back to December of the previous year
+    if today.month == 1:
+        year, month = today.year - 1, 12
+    else:
+        year, month = today.year, today.month - 1
 
-    # Last day of previous month = day before first day of current month
-    last_day_previous_month = first_day_current_month - datetime.timedelta(days=1)
-    first_day_previous_month = last_day_previous_month.replace(day=1)
-    return first_day_previous_month.strftime(
-        "%Y-%m-%d"
-    ), first_day_current_month.strftime("%Y-%m-%d")
+    first_day_previous_month = datetime.date(year, month, 1)
+    first_day_current_month = datetime.date(today.year, today.month, 1)
+    return first_day_previous_month.isoformat(), first_day_current_month.isoformat()
 
 
-def get_cost_for_workload(ce_client, account_ids, start_date, end_date):
+def get_costs_grouped(ce_client, account_ids, start_date, end_date) -> dict:
     """
-    Retrieves the total cost for the provided account IDs for the period between
-    start_date and end_date using Cost Explorer. End date is first day of current month!
+    Retrieves the cost per linked account for the provided account IDs for the period
+    between start_date and end_date using a single grouped Cost Explorer query.
+    End date is first day of current month! Errors are raised rather than returning
+    partial costs, so budgets are never set from incomplete data.
     """
     cost_metric = "NetAmortizedCost"  # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ce/client/get_cost_and_usage.html#:~:text=(string)%20%E2%80%93-,Metrics,-(list)%20%E2%80%93
 
-    try:
-        response = ce_client.get_cost_and_usage(
-            TimePeriod={"Start": start_date, "End": end_date},
-            Granularity="MONTHLY",
-            Metrics=[cost_metric],
-            Filter={"Dimensions": {"Key": "LINKED_ACCOUNT", "Values": account_ids}},
-        )
-    except Exception as e:
-        logger.error(f"Error fetching cost for accounts {account_ids}: {e}")
-        return 0.0
-    # Parse the returned cost amount (as a string) and convert to float
-    try:
-        results = response.get("ResultsByTime", [])
-        if results:
-            total_str = (
-                results[0].get("Total", {}).get(cost_metric, {}).get("Amount", "0")
-            )
-            cost = float(total_str)
-            return cost
-    except Exception as e:
-        logger.error(f"Error parsing cost response: {e}")
-    return 0.0
+    account_costs = defaultdict(float)
+    request = {
+        "TimePeriod": {"Start": start_date, "End": end_date},
+        "Granularity": "MONTHLY",
+        "Metrics": [cost_metric],
+        "GroupBy": [{"Type": "DIMENSION", "Key": "LINKED_ACCOUNT"}],
+        "Filter": {"Dimensions": {"Key": "LINKED_ACCOUNT", "Values": account_ids}},
+    }
+    # Cost Explorer has no paginator for get_cost_and_usage, so follow the token
+    while True:
+        try:
+            response = ce_client.get_cost_and_usage(**request)
+        except Exception as e:
+            logger.error("Error fetching cost for accounts: %s", e)
+            raise
+        # Parse the returned cost amounts (as strings) and convert to float
+        try:
+            for result in response.get("ResultsByTime", []):
+                for group in result.get("Groups", []):
+                    amount = group.get("Metrics", {}).get(cost_metric, {})
+                    account_costs[group["Keys"][0]] += float(
+                        amount.get("Amount", "0")
+                    )
+        except Exception as e:
+            logger.error("Error parsing cost response: %s", e)
+            raise
+        token = response.get("NextPageToken")
+        if not token:
+            break
+        request["NextPageToken"] = token
+    return dict(account_costs)
 
 
 def format_notification(
@@ -188,6 +197,18 @@ def format_notification(
         }
 
 
+@functools.lru_cache(maxsize=512)
+def format_notifications(workload_email: str | None = None) -> tuple[dict, ...]:
+    """
+    Builds the alert notifications for a workload email. The result is cached per
+    email and shared between workloads, so it must not be modified.
+    """
+    return (
+        format_notification(105, workload_email),  # 105% Alert notification
+        format_notification(120, workload_email),  # 120% Alert notification
+    )
+
+
 def create_or_update_budget(
     budgets_client,
     budget_name,
@@ -223,10 +244,7 @@ def create_or_update_budget(
         },
     }
 
-    notifications_with_subscribers = [
-        format_notification(105, workload_email),  # 105% Alert notification
-        format_notification(120, workload_email),  # 120% Alert notification
-    ]
+    notifications_with_subscribers = list(format_notifications(workload_email))
 
     logger.debug(notifications_with_subscribers)
 
@@ -238,20 +256,34 @@ def create_or_update_budget(
             BudgetName=budget_name,
         )
         exists = True
-        logger.info(
-            f"Budget '{budget_name}' exists. Deleting the current one before replacing it."
-        )
+        logger.info("Budget '%s' exists. Updating it in place.", budget_name)
     except budgets_client.exceptions.NotFoundException:
-        logger.info(f"Budget '{budget_name}' does not exist. Creating it.")
+        logger.info("Budget '%s' does not exist. Creating it.", budget_name)
     except Exception as e:
-        logger.error(f"Error checking budget '{budget_name}': {e}")
+        logger.error("Error checking budget '%s': %s", budget_name, e)
 
     if exists:
         try:
-            budgets_client.delete_budget(AccountId=root_account, BudgetName=budget_name)
-            logger.info(f"Deleted budget '{budget_name}'")
+            budgets_client.update_budget(
+                AccountId=root_account, NewBudget=budget_object
+            )
+            logger.info(
+                "Updated budget '%s' with limit: %.2f USD", budget_name, budget_amount
+            )
         except Exception as e:
-            logger.error(f"Failed to delete budget '{budget_name}': {e}")
+            logger.error("Failed to update budget '%s': %s", budget_name, e)
+            return
+
+        try:
+            sync_notifications(
+                budgets_client,
+                budget_name,
+                root_account,
+                notifications_with_subscribers,
+            )
+        except Exception as e:
+            logger.error("Failed to update notifications of '%s': %s", budget_name, e)
+        return
 
     try:
         budgets_client.create_budget(
@@ -260,10 +292,150 @@ def create_or_update_budget(
             NotificationsWithSubscribers=notifications_with_subscribers,
         )
         logger.info(
-            f"Created budget '{budget_name}' with limit: {budget_amount:.2f} USD"
+            "Created budget '%s' with limit: %.2f USD", budget_name, budget_amount
         )
     except Exception as e:
-        logger.error(f"Failed to create budget '{budget_name}': {e}")
+        logger.error("Failed to create budget '%s': %s", budget_name, e)
+
+
+def notification_key(notification: dict) -> tuple:
+    """
+    Identifies a notification by the fields that budgets use to tell them apart.
+    """
+    return (
+        notification["NotificationType"],
+        notification["ComparisonOperator"],
+        float(notification["Threshold"]),
+        notification.get("ThresholdType", "PERCENTAGE"),
+    )
+
+
+def run_budget_operations(operations: list[tuple]) -> None:
+    """
+    Runs Budgets API calls, given as (method, kwargs) pairs, one at a time and logs any
+    failures. Workloads are already processed concurrently by the handler, so this
+    keeps the shared Budgets client within its connection pool.
+    """
+    for operation, kwargs in operations:
+        try:
+            operation(**kwargs)
+        except Exception as e:
+            logger.error("Failed to %s: %s", operation.__name__, e)
+
+
+def sync_notifications(
+    budgets_client,
+    budget_name: str,
+    root_account: str,
+    notifications_with_subscribers: list[dict],
+) -> None:
+    """
+    Brings the notifications of an existing budget in line with the desired ones.
+    Only the notifications and subscribers that differ are created or deleted.
+    """
+    budget = {"AccountId": root_account, "BudgetName": budget_name}
+    desired = {
+        notification_key(n["Notification"]): n for n in notifications_with_subscribers
+    }
+    current = {
+        notification_key(n): n
+        for n in budgets_client.describe_notifications_for_budget(**budget).get(
+            "Notifications", []
+        )
+    }
+
+    additions = []
+    removals = [
+        (budgets_client.delete_notification, {**budget, "Notification": notification})
+        for key, notification in current.items()
+        if key not in desired
+    ]
+    for key, notification in desired.items():
+        if key not in current:
+            additions.append(
+                (budgets_client.create_notification, {**budget, **notification})
+            )
+            continue
+
+        # The notification exists, so only its subscribers may need to change
+        existing = {
+            (s["SubscriptionType"], s["Address"])
+            for s in budgets_client.describe_subscribers_for_notification(
+                **budget, Notification=current[key]
+            ).get("Subscribers", [])
+        }
+        wanted = {
+            (s["SubscriptionType"], s["Address"]) for s in notification["Subscribers"]
+        }
+        for subscription_type, address in wanted - existing:
+            additions.append(
+                (
+                    budgets_client.create_subscriber,
+                    {
+                        **budget,
+                        "Notification": current[key],
+                        "Subscriber": {
+                            "SubscriptionType": subscription_type,
+                            "Address": address,
+                        },
+                    },
+                )
+            )
+        for subscription_type, address in existing - wanted:
+            removals.append(
+                (
+                    budgets_client.delete_subscriber,
+                    {
+                        **budget,
+                        "Notification": current[key],
+                        "Subscriber": {
+                            "SubscriptionType": subscription_type,
+                            "Address": address,
+                        },
+                    },
+                )
+            )
+
+    # Add before removing so a notification never ends up without subscribers
+    run_budget_operations(additions)
+    run_budget_operations(removals)
+    logger.info(
+        "Notifications of '%s': %s added, %s removed",
+        budget_name,
+        len(additions),
+        len(removals),
+    )
+
+
+def process_workload(
+    budgets_client,
+    workload: str,
+    account_ids: list[str],
+    budget_amount: float,
+    root_account: str,
+    email_index: dict,
+):
+    """
+    Sets the budget for a single workload to the given amount.
+    """
+    logger.info("Processing workload '%s' for account IDs: %s", workload, account_ids)
+    logger.info("Workload '%s' - Set budget amount: %.2f USD", workload, budget_amount)
+
+    # Construct a budget name. For example: "Budget-ecommerce"
+    budget_name = f"AUTO-workload-{workload}"
+
+    # Get the workload email, defaulting to None if not found
+    workload_email = retrieve_metadata_per_workload(workload, account_ids, email_index)
+
+    # Create or update the budget and configure its notifications
+    create_or_update_budget(
+        budgets_client,
+        budget_name,
+        budget_amount,
+        root_account,
+        account_ids,
+        workload_email,
+    )
 
 
 def handler(event, context):
@@ -273,70 +445,94 @@ def handler(event, context):
     """
     logger.info("FinOps BudgetSetter Lambda started")
 
-    # Assume role in the target account
-    credentials = assume_role(role_arn)
-
-    # Initialize Boto3 clients with assumed role credentials
-    ce_client, budgets_client, sts_core_mgmt_client = initialize_boto3_clients(credentials)
+    # Assume role in the target account (if configured) and initialize Boto3 clients
+    ce_client, budgets_client, sts_core_mgmt_client = get_clients()
 
     # Get the caller's account ID (this account is where the budgets are managed)
-    root_account = sts_core_mgmt_client.get_caller_identity().get("Account")
-    logger.info(f"Operating in AWS Account: {root_account}")
+    global root_account_id
+    if root_account_id is None:
+        root_account_id = sts_core_mgmt_client.get_caller_identity().get("Account")
+    root_account = root_account_id
+    logger.info("Operating in AWS Account: %s", root_account)
 
     # Calculate the date range for the fully completed previous month
     start_date, end_date = get_previous_month_date_range()
-    logger.info(f"Cost-capture period: {start_date} to {end_date}")
+    logger.info("Cost-capture period: %s to %s", start_date, end_date)
 
-    # Retrieve all accounts managed by the central organisation
+    # Retrieve all accounts managed by the central organisation and group them
+    # using the naming convention: {workload}-{env}
     try:
-        accounts = get_all_accounts(ce_client, start_date, end_date)
+        workload_accounts = group_accounts_by_workload(
+            iter_accounts(ce_client, start_date, end_date)
+        )
     except Exception as e:
-        logger.error(f"Error listing accounts: {e}")
+        logger.error("Error listing accounts: %s", e)
         return {"status": "error", "message": "Could not list accounts."}
-
-    # Group accounts using the naming convention: {workload}-{env}
-    workload_accounts = group_accounts_by_workload(accounts)
     if not workload_accounts:
         logger.info("No accounts found that match the naming convention. Exiting.")
         return {"status": "success", "message": "No matching accounts."}
 
     # Retrieve email of workloads
-    metadata_mapping = load_metadata_from_s3(
+    email_index = load_cached_metadata_from_s3(
         s3_client, account_metadata_bucket, account_metadata_filename
     )
     logger.info("Retrieved account metadata")
 
-    # Process each workload group
-    for workload, account_ids in workload_accounts.items():
-        logger.info(f"Processing workload '{workload}' for account IDs: {account_ids}")
-
-        # Query Cost Explorer for the workload cost during the previous month
-        cost = get_cost_for_workload(ce_client, account_ids, start_date, end_date)
-
-        # Minimum budget is 500 USD to avoid email spam
-        if cost < 500:
-            logger.info("Cost under 500 USD. Setting budget to 500 to avoid email spam")
-            cost = 500
-
-        logger.info(f"Workload '{workload}' - Set budget amount: {cost:.2f} USD")
-
-        # Construct a budget name. For example: "Budget-ecommerce"
-        budget_name = f"AUTO-workload-{workload}"
-
-        # Get the workload email, defaulting to None if not found
-        workload_email = retrieve_metadata_per_workload(
-            workload, account_ids, metadata_mapping
+    # Query Cost Explorer once for the cost of every grouped account last month
+    try:
+        account_costs = get_costs_grouped(
+            ce_client,
+            [a for account_ids in workload_accounts.values() for a in account_ids],
+            start_date,
+            end_date,
         )
+    except Exception as e:
+        logger.error("Error retrieving workload costs: %s", e)
+        return {"status": "error", "message": "Could not retrieve costs."}
 
-        # Create or update the budget and configure its notifications
-        create_or_update_budget(
-            budgets_client,
-            budget_name,
-            cost,
-            root_account,
-            account_ids,
-            workload_email,
-        )
+    # Workloads without any Cost Explorer activity don't need a budget. Only reached
+    # with a complete cost result, so a failed query never skips workloads.
+    active_workloads = {}
+    for workload, account_ids in workload_accounts.items():
+        if any(a in account_costs for a in account_ids):
+            active_workloads[workload] = account_ids
+        else:
+            logger.info("Skipping workload '%s' without any cost activity", workload)
+
+    # Budget is last month's cost, with a minimum to avoid email spam
+    budget_amounts = {}
+    for workload, account_ids in active_workloads.items():
+        cost = sum(account_costs.get(a, 0.0) for a in account_ids)
+        if cost < min_budget:
+            logger.info(
+                "Workload '%s' cost under %.2f USD. Setting budget to %.2f to avoid "
+                "email spam",
+                workload,
+                min_budget,
+                min_budget,
+            )
+        budget_amounts[workload] = max(cost, min_budget)
+
+    # Process the workload groups concurrently; the work is bound by API latency
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                process_workload,
+                budgets_client,
+                workload,
+                active_workloads[workload],
+                budget_amount,
+                root_account,
+                email_index,
+            ): workload
+            for workload, budget_amount in budget_amounts.items()
+        }
+        for future in as_completed(futures):
+            workload = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error("Error processing workload '%s': %s", workload, e)
 
     logger.info("FinOps BudgetSetter Lambda completed successfully")
     return {"status": "success"}
@@ -1,20 +1,26 @@
 from log_config import logger
 import json
-import boto3
 
-s3_client = boto3.client("s3")
+ignore_emails_for_workloads = frozenset(
+    {"finopsmanagement", "cloudintelligencedashboard"}
+)
 
-ignore_emails_for_workloads = ["finopsmanagement", "cloudintelligencedashboard"]
+# Email index per S3 object, reused across warm invocations while the ETag matches
+metadata_cache = {}
 
 
-def load_metadata_from_s3(s3_client, bucket, filename):
+def load_metadata_from_s3(s3_client, bucket, filename) -> dict:
+    """
+    Reads the account metadata from S3 and indexes it as a mapping of account IDs to
+    their email, leaving out accounts without one.
+    """
     try:
         # Fetch the CSV file from S3
         response = s3_client.get_object(Bucket=bucket, Key=filename)
 
         logger.info("Workload email data read from S3")
     except Exception as e:
-        logger.warning(f"Issue retrieving workload mapping from S3: {e}")
+        logger.warning("Issue retrieving workload mapping from S3: %s", e)
         return {}
 
     try:
@@ -23,46 +29,69 @@ def load_metadata_from_s3(s3_client, bucket, filename):
 
         # Convert the JSON string back to a dictionary
         metadata_mapping = json.loads(json_data)
-        return metadata_mapping
+        return {
+            account_id: metadata["email"]
+            for account_id, metadata in metadata_mapping.items()
+            if metadata.get("email")
+        }
 
     except Exception as e:
-        logger.warning(f"Issue decoding workload mapping file from S3: {e}")
+        logger.warning("Issue decoding workload mapping file from S3: %s", e)
         return {}
 
 
+def load_cached_metadata_from_s3(s3_client, bucket, filename):
+    """
+    Returns the account email index from S3. The index built by a previous warm
+    invocation is reused as long as the ETag of the object hasn't changed.
+    """
+    try:
+        etag = s3_client.head_object(Bucket=bucket, Key=filename)["ETag"]
+    except Exception as e:
+        logger.warning("Issue checking workload mapping in S3: %s", e)
+        return load_metadata_from_s3(s3_client, bucket, filename)
+
+    cached = metadata_cache.get((bucket, filename))
+    if cached is not None and cached[0] == etag:
+        logger.info("Workload email data unchanged in S3. Using cached data")
+        return cached[1]
+
+    email_index = load_metadata_from_s3(s3_client, bucket, filename)
+    # Only cache successful reads, failures return an empty index
+    if email_index:
+        metadata_cache[(bucket, filename)] = (etag, email_index)
+    return email_index
+
+
 def retrieve_metadata_per_workload(
-    workload: str, account_ids: list[str], metadata: dict
+    workload: str, account_ids: list[str], email_index: dict
 ) -> str:
     """
     Looks up emails based on account IDs provided in a list.
 
     Parameters:
     - account_ids (list[str]): A list of account IDs to look up.
-    - email_dict (dict): A dictionary mapping account IDs to emails.
+    - email_index (dict): A dictionary mapping account IDs to emails.
 
     Returns:
-    - dict: A mapping of account IDs to their corresponding emails.
+    - str: The email of the first account that has one.
     """
     if workload in ignore_emails_for_workloads:
         logger.info(
-            f"Workload ({workload}) is owned by FinOps team. Ignoring SNOW address."
+            "Workload (%s) is owned by FinOps team. Ignoring SNOW address.", workload
         )
         return None
-    if metadata is None:
+    if email_index is None:
         logger.warning("Metadata not found. Is object succesfully retrieved?")
         return None
     if workload == "Not found":
         return None
 
-    email = None
     for account_id in account_ids:
-        email = metadata.get(account_id, {}).get("email", None)
-
-        if email is not None:
-            logger.debug(f"Email found for: {account_id} - email: {email}")
+        email = email_index.get(account_id)
+        if email:
+            logger.debug("Email found for: %s - email: %s", account_id, email)
             return email
 
-    if email == None:
-        logger.info(f"No email found for workload: {workload}")
-
-    return email
+    logger.info("No email found for workload: %s", workload)
+    return None
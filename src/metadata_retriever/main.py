@@ -1,12 +1,19 @@
-import urllib.request
 import json
 import os
+import re
+import sys
 import boto3
+import urllib3
+from botocore.config import Config
 from log_config import logger
-from io import StringIO
+import io
 import csv
 import json
 import base64
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import BinaryIO, Iterable, Iterator
 
 base_url = os.getenv("SERVICENOW_BASE_URL", None)
 username_path = os.getenv("SERVICENOW_USER_PATH", None)
@@ -20,7 +27,15 @@ finops_automation_filename = os.getenv(
     "FINOPS_AUTOMATION_FILENAME", "reference_data/lambda_automation_metadata.json"
 )
 
-s3_client = boto3.client("s3")
+# Keep connections alive and retry adaptively for the concurrent S3 uploads
+s3_client = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=16,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        tcp_keepalive=True,
+    ),
+)
 ssm_client = boto3.client("ssm")
 
 username = ssm_client.get_parameter(Name=username_path, WithDecryption=True)['Parameter']['Value']
@@ -31,76 +46,113 @@ data_format = "CSV"
 url = f"{base_url}/cmdb_ci_cloud_service_account_list.do?{data_format}=&sysparm_fields=name%2Caccount_id%2Cenvironment%2Cassignment_group%2Cassignment_group.email"
 credentials = f"{username}:{password}"
 encoded_credentials = base64.b64encode(credentials.encode("utf-8")).decode("utf-8")
-headers = {"Authorization": f"Basic {encoded_credentials}"}
-
-
-def decode_snow_data(response):
-    data = response.decode("utf-8")
-    logger.info("Decoded ServiceNow data")
-    logger.debug(data[:100])
-
-    # Use StringIO to convert the string data into a file-like object
-    csv_file = StringIO(data)
-
-    # Read the CSV data
-    csv_reader = csv.DictReader(csv_file)
-    dict_list = [row for row in csv_reader]
-    return dict_list
-
+headers = {"Authorization": f"Basic {encoded_credentials}", "Accept-Encoding": "gzip"}
+
+# Connection pool reused across warm invocations
+http = urllib3.PoolManager()
+
+# Workloads starting with these belong to BSP and the data platform respectively
+bsp_prefix = "bsp"
+dataplatform_prefix = "dp"
+# Workloads containing any of these also belong to the data platform
+platform_substrings = ("dataplatform", "marketingdata", "hrpoc")
+platform_pattern = re.compile("|".join(map(re.escape, platform_substrings)))
+
+# Outputs larger than this are uploaded in parts, S3 requires parts of at least 5 MiB
+multipart_part_size = 8 * 1024 * 1024
+
+# Columns read from the ServiceNow export, in the order they are unpacked
+snow_columns = (
+    "account_id",
+    "name",
+    "environment",
+    "assignment_group",
+    "assignment_group.email",
+)
 
-def format_cudos_data(
-    dict_list: list[dict], assignment_group_mapping: dict, email_mapping: dict
-) -> list[dict]:
-    def remove_snow_team(temp_dict: dict, workload: str):
-        if workload == "Not found":
-            temp_dict["assignment_group"] = "Not found"
-            temp_dict["email"] = "Not found"
-        return temp_dict
 
-    def dict_format(row):
-        workload = split_workload(
-            account_id=row["account_id"], workload_env=row["name"]
-        )
+def decode_snow_data(response: BinaryIO) -> Iterator[tuple[str, ...]]:
+    """
+    Parses the ServiceNow CSV export while it is streamed from the response, yielding
+    one tuple per account that holds the values of snow_columns in that order.
+    """
+    csv_reader = csv.reader(io.TextIOWrapper(response, encoding="utf-8", newline=""))
+
+    # Locate the columns from the header once
+    header = next(csv_reader, None)
+    if header is None:
+        return
+    logger.info("Decoding ServiceNow data")
+    logger.debug(header)
+    columns = itemgetter(*(header.index(column) for column in snow_columns))
+    header_length = len(header)
+
+    # Skip blank lines like csv.DictReader does
+    for row in csv_reader:
+        if not row:
+            continue
+        # Treat missing trailing fields of a short row as empty
+        if len(row) < header_length:
+            row += [""] * (header_length - len(row))
+        yield columns(row)
+
+
+def format_snow_data(
+    rows: Iterable[tuple[str, ...]],
+) -> tuple[list[dict[str, str]], dict[str, dict[str, str]]]:
+    """
+    Formats the ServiceNow rows into the CUDOS list and the budget mapping.
+    The first pass consumes the rows, derives the workload of every row and collects
+    the assignment group and email per workload, so rows missing them can be augmented.
+    The second pass builds both outputs.
+    """
+    rows_with_workload: list[tuple[tuple[str, ...], str]] = []
+    assignment_group_mapping: dict[str, str] = {}
+    email_mapping: dict[str, str] = {}
+    for row in rows:
+        account_id, name, _, assignment_group, email = row
+        # Workloads repeat across accounts, so share a single string object
+        workload = sys.intern(split_workload(account_id=account_id, workload_env=name))
+        rows_with_workload.append((row, workload))
+        # The first row of a workload with a value wins
+        if assignment_group and workload not in assignment_group_mapping:
+            assignment_group_mapping[workload] = assignment_group
+        if email and workload not in email_mapping:
+            email_mapping[workload] = email
+
+    cudos_list: list[dict[str, str]] = []
+    account_dict: dict[str, dict[str, str]] = {}
+    for (account_id, name, environment, _, _), workload in rows_with_workload:
+        environment = sys.intern(environment)
         workload_type = identify_platform(workload)
+        assignment_group = assignment_group_mapping.get(workload, "")
+        email = email_mapping.get(workload, "")
 
-        temp_dict = {
-            "account_id": row["account_id"],
-            "name": row["name"],
-            "workload": workload,
-            "workload_type": workload_type,
-            "environment": row["environment"],
-            "assignment_group": assignment_group_mapping.get(workload, ""),
-            "email": email_mapping.get(workload, ""),
-        }
-
-        temp_dict = remove_snow_team(temp_dict, workload)
-
-        return temp_dict
-
-    cudos_list = [dict_format(row) for row in dict_list]
-    return cudos_list
-
-
-def format_budget_data(
-    dict_list: list[dict], assignment_group_mapping: dict, email_mapping: dict
-) -> dict:
-    def dict_format(row: dict):
-        workload = split_workload(
-            account_id=row["account_id"], workload_env=row["name"]
+        # Accounts without a workload shouldn't be attributed to the ServiceNow team
+        if workload == "Not found":
+            cudos_assignment_group = cudos_email = "Not found"
+        else:
+            cudos_assignment_group, cudos_email = assignment_group, email
+        cudos_list.append(
+            {
+                "account_id": account_id,
+                "name": name,
+                "workload": workload,
+                "workload_type": workload_type,
+                "environment": environment,
+                "assignment_group": cudos_assignment_group,
+                "email": cudos_email,
+            }
         )
-        workload_type = identify_platform(workload)
-
-        return {
-            "name": row["name"],
+        account_dict[account_id] = {
+            "name": name,
             "workload": workload,
             "workload_type": workload_type,
-            "environment": row["environment"],
-            "assignment_group": assignment_group_mapping.get(workload, ""),
-            "email": email_mapping.get(workload, ""),
+            "environment": environment,
+            "assignment_group": assignment_group,
+            "email": email,
         }
-
-    account_dict = {row["account_id"]: dict_format(row) for row in dict_list}
-    return account_dict
+    return cudos_list, account_dict
 
 
 def split_workload(account_id: str, workload_env: str) -> str:
@@ -111,68 +163,121 @@ def split_workload(account_id: str, workload_env: str) -> str:
     return workload_env
 
 
+@functools.lru_cache(maxsize=4096)
 def identify_platform(workload: str) -> str:
-    if workload.startswith("bsp"):
+    if workload.startswith(bsp_prefix):
         workload_type = "bsp"
-    elif (
-        workload.startswith("dp")
-        or "dataplatform" in workload
-        or "marketingdata" in workload
-        or "hrpoc" in workload
-    ):
+    elif workload.startswith(dataplatform_prefix) or platform_pattern.search(workload):
         workload_type = "dataplatform"
     else:
         workload_type = "NA"
     return workload_type
 
 
-def augment_missing_data(key: str, data: list[dict]) -> list[dict]:
-    # Create a mapping of (workload, environment) to email
-    augmentation_mapping = {
-        split_workload(account_id=row["account_id"], workload_env=row["name"]): row[key]
-        for row in data
-        if row[key]
-    }
-    return augmentation_mapping
+def json_line(item: dict[str, str]) -> bytes:
+    """
+    Serializes an item as a single line of JSON.
+    """
+    return (json.dumps(item) + "\n").encode("utf-8")
 
 
 def store_hive_json_objects_in_s3(
-    s3_client, data: dict, filename: str, bucket: str = finops_bucket
+    s3_client, data: list[dict[str, str]], filename: str, bucket: str = finops_bucket
 ) -> None:
-    # Store the results in a string
-    output_string = ""
-    for item in data:
-        output_string += json.dumps(item) + "\n"
+    """
+    Stores the data in S3 with one JSON object per line. Small outputs are stored with a
+    single put_object. Once the output exceeds a part, it is streamed as a multipart
+    upload so only one part is held in memory.
+    """
+    buffer = bytearray()
+    upload_id = None
+    parts: list[dict[str, str | int]] = []
+    try:
+        for item in data:
+            buffer += json_line(item)
+            if len(buffer) < multipart_part_size:
+                continue
+            if upload_id is None:
+                upload_id = s3_client.create_multipart_upload(
+                    Bucket=bucket, Key=filename, ContentType="text/plain"
+                )["UploadId"]
+            parts.append(
+                upload_part(
+                    s3_client, bucket, filename, upload_id, len(parts) + 1, buffer
+                )
+            )
+            buffer = bytearray()
+
+        if upload_id is None:
+            s3_client.put_object(
+                Bucket=bucket,
+                Key=filename,
+                Body=buffer,
+                ContentType="text/plain",
+            )
+        else:
+            if buffer:
+                parts.append(
+                    upload_part(
+                        s3_client, bucket, filename, upload_id, len(parts) + 1, buffer
+                    )
+                )
+            s3_client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=filename,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+    except Exception:
+        # Don't leave the parts uploaded so far behind
+        if upload_id is not None:
+            s3_client.abort_multipart_upload(
+                Bucket=bucket, Key=filename, UploadId=upload_id
+            )
+        raise
 
-    s3_client.put_object(
+    logger.info(f"Saved {filename} to {bucket}")
+
+
+def upload_part(
+    s3_client,
+    bucket: str,
+    filename: str,
+    upload_id: str,
+    part_number: int,
+    body: bytes | bytearray,
+) -> dict[str, str | int]:
+    """
+    Uploads one part of a multipart upload and returns its entry for completing it.
+    """
+    response = s3_client.upload_part(
         Bucket=bucket,
         Key=filename,
-        Body=output_string,
-        ContentType="text/plain",
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=body,
     )
-
-    # USED FOR DEBUGGING
-    # with open(filename, "w") as f:
-    #     f.writelines(output_string)
-
-    logger.info(f"Saved {filename} to {bucket}")
+    return {"ETag": response["ETag"], "PartNumber": part_number}
 
 
 def store_json_in_s3(
-    s3_client, data: dict, filename: str, bucket: str = finops_bucket
+    s3_client,
+    data: dict[str, dict[str, str]],
+    filename: str,
+    bucket: str = finops_bucket,
 ) -> None:
-    json_formatted_string = json.dumps(data, indent=2)
+    json_formatted_bytes = json.dumps(data, indent=2).encode("utf-8")
 
     s3_client.put_object(
         Bucket=bucket,
         Key=filename,
-        Body=json_formatted_string,
+        Body=json_formatted_bytes,
         ContentType="application/json",
     )
 
     # USED FOR DEBUGGING
-    # with open(filename, "w") as f:
-    #     f.writelines(json_formatted_string)
+    # with open(filename, "wb") as f:
+    #     f.write(json_formatted_bytes)
 
     logger.info(f"Saved {filename} to {bucket}")
 
@@ -183,28 +288,43 @@ def handler(event, context):
     Triggered on a monthly EventBridge schedule.
     """
 
-    # Making the request
-    req = urllib.request.Request(url, headers=headers)
-    with urllib.request.urlopen(req, timeout=10) as response:
-        response_data = response.read()
-        logger.info("Succesfully requested data from ServiceNow")
-
-    dict_list = decode_snow_data(response_data)
-
-    assignment_group_augmentation = augment_missing_data("assignment_group", dict_list)
-    email_augmentation = augment_missing_data("assignment_group.email", dict_list)
-
-    cudos_data = format_cudos_data(
-        dict_list, assignment_group_augmentation, email_augmentation
-    )
-    store_hive_json_objects_in_s3(
-        s3_client, cudos_data, cudos_filename, cloudintelligence_bucket
+    # Making the request, parsing the CSV while it is being received. The gzip encoded
+    # response is decompressed by urllib3 as it is read.
+    response = http.request(
+        "GET", url, headers=headers, preload_content=False, timeout=10
     )
-
-    budget_data = format_budget_data(
-        dict_list, assignment_group_augmentation, email_augmentation
-    )
-    store_json_in_s3(s3_client, budget_data, finops_automation_filename, finops_bucket)
+    try:
+        if response.status != 200:
+            raise urllib3.exceptions.HTTPError(
+                f"ServiceNow request failed with status {response.status}"
+            )
+        logger.info("Succesfully requested data from ServiceNow")
+        # Keep the response open for the TextIOWrapper until all rows are read
+        response.auto_close = False
+        cudos_data, budget_data = format_snow_data(decode_snow_data(response))
+    finally:
+        response.release_conn()
+
+    # Both objects are independent, so upload them concurrently
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        uploads = [
+            executor.submit(
+                store_hive_json_objects_in_s3,
+                s3_client,
+                cudos_data,
+                cudos_filename,
+                cloudintelligence_bucket,
+            ),
+            executor.submit(
+                store_json_in_s3,
+                s3_client,
+                budget_data,
+                finops_automation_filename,
+                finops_bucket,
+            ),
+        ]
+        for upload in uploads:
+            upload.result()
 
     return {"status": "success"}
 